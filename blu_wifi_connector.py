@@ -6,7 +6,9 @@ BLE provisioning server for Raspberry Pi:
 - Read/write Device ID
 - Notify client of current Wi-Fi status and Device ID
 
-Uses Bluezero peripheral and D-Bus to advertise over BLE.
+Uses Bluezero peripheral and D-Bus to advertise over BLE. NetworkManager is
+driven through its D-Bus API over GDBus (Gio); dbus-python is only kept for
+Bluezero.
 """
 import os
 import sys
@@ -14,10 +16,9 @@ import json
 import time
 import logging
 import subprocess
-import dbus
 import dbus.mainloop.glib
-from gi.repository import GLib
-from bluezero import adapter, peripheral, async_tools
+from gi.repository import GLib, Gio
+from bluezero import adapter, peripheral
 
 # -------- Configuration --------
 BLE_SERVICE_UUID = '12345678-1234-5678-1234-56789abcdef0'
@@ -25,11 +26,32 @@ BLE_CHAR_UUID    = '12345678-1234-5678-1234-56789abcdef2'
 
 WIFI_FILE        = '/home/neonflake/Desktop/visitwise/last_wifi_credentials.json'
 DEVICE_ID_FILE   = '/home/neonflake/Desktop/visitwise/device_id.txt'
+STATUS_CACHE_TTL = 10  # seconds
+WIFI_READY_TIMEOUT = 10  # seconds to wait for the Wi-Fi device to come up
+WIFI_CONNECT_TIMEOUT = 45  # seconds to wait for the connection to activate
+
+# NetworkManager D-Bus API
+NM_BUS_NAME      = 'org.freedesktop.NetworkManager'
+NM_PATH          = '/org/freedesktop/NetworkManager'
+NM_DEVICE_IFACE  = 'org.freedesktop.NetworkManager.Device'
+NM_ACTIVE_IFACE  = 'org.freedesktop.NetworkManager.Connection.Active'
+NM_SETTINGS_PATH = '/org/freedesktop/NetworkManager/Settings'
+NM_SETTINGS_IFACE = 'org.freedesktop.NetworkManager.Settings'
+NM_CONNECTION_IFACE = 'org.freedesktop.NetworkManager.Settings.Connection'
+NM_WIRELESS_IFACE = 'org.freedesktop.NetworkManager.Device.Wireless'
+NM_AP_IFACE      = 'org.freedesktop.NetworkManager.AccessPoint'
+DBUS_PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
+NM_DEVICE_TYPE_WIFI = 2
+NM_DEVICE_STATE_DISCONNECTED = 30
+NM_ACTIVE_STATE_ACTIVATED = 2
+NM_ACTIVE_STATE_DEACTIVATING = 3
+NM_AP_SEC_KEY_MGMT_PSK = 0x100
+NM_AP_SEC_KEY_MGMT_SAE = 0x400
 
 # Logging setup
 tlogging = logging.getLogger(__name__)
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.DEBUG if os.environ.get('VISITWISE_DEBUG') else logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
     handlers=[
         logging.FileHandler('/home/neonflake/Desktop/visitwise/ble_log.txt'),
@@ -38,149 +60,422 @@ logging.basicConfig(
 )
 
 # -------- Persistence --------
+def write_file_atomic(path, content):
+    """Write via a synced temp file + rename so a power cut never leaves path truncated.
+
+    The file is created owner-only (0600) since it may hold the Wi-Fi password.
+    """
+    tmp = f"{path}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # in case a stale temp file was left with other modes
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        # Do not leave a half-written copy of the credentials next to the real file
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
 def save_json(path, data):
     try:
-        with open(path, 'w') as f:
-            json.dump(data, f)
-        logging.info(f"Saved JSON to {path}")
+        write_file_atomic(path, json.dumps(data))
+        logging.info("Saved JSON to %s", path)
+        return True
     except Exception as e:
-        logging.error(f"Failed to save JSON: {e}")
+        logging.error("Failed to save JSON: %s", e)
+        return False
 
 def load_json(path):
     try:
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                return json.load(f)
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logging.error(f"Failed to load JSON: {e}")
+        logging.error("Failed to load JSON: %s", e)
     return {}
 
 # -------- Device ID Persistence --------
+# Only this process writes the file, so it is read once and then served from
+# memory; save_device_id() keeps the cached value in sync.
+_device_id_cache = None
+
 def save_device_id(new_id):
+    global _device_id_cache
     try:
-        with open(DEVICE_ID_FILE, 'w') as f:
-            f.write(new_id.strip())
-        logging.info(f"Saved Device ID: {new_id}")
+        write_file_atomic(DEVICE_ID_FILE, new_id.strip())
+        _device_id_cache = new_id.strip()
+        rebuild_payload()
+        logging.info("Saved Device ID: %s", new_id)
     except Exception as e:
-        logging.error(f"Failed to save Device ID: {e}")
+        logging.error("Failed to save Device ID: %s", e)
 
 def load_device_id():
+    global _device_id_cache
+    if _device_id_cache is not None:
+        return _device_id_cache
+    _device_id_cache = 'DEV_DEFAULT'
     try:
-        if os.path.exists(DEVICE_ID_FILE):
-            with open(DEVICE_ID_FILE, 'r') as f:
-                return f.read().strip()
+        with open(DEVICE_ID_FILE, 'r') as f:
+            _device_id_cache = f.read().strip()
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logging.error(f"Failed to load Device ID: {e}")
-    return 'DEV_DEFAULT'
+        logging.error("Failed to load Device ID: %s", e)
+    return _device_id_cache
 
 # -------- Wi-Fi Logic --------
+_wifi_cache = None
+
 def save_wifi(ssid, password):
-    save_json(WIFI_FILE, {'ssid': ssid, 'password': password})
+    global _wifi_cache
+    data = {'ssid': ssid, 'password': password}
+    if save_json(WIFI_FILE, data):
+        _wifi_cache = data
 
 def load_wifi():
-    data = load_json(WIFI_FILE)
-    return data.get('ssid'), data.get('password')
+    global _wifi_cache
+    if _wifi_cache is None:
+        _wifi_cache = load_json(WIFI_FILE)
+    return _wifi_cache.get('ssid'), _wifi_cache.get('password')
+
+# Cached result of the last status lookup; NetworkManager is only consulted
+# once the entry is older than STATUS_CACHE_TTL seconds.
+_status_cache = {'t': 0, 'v': 'Not connected'}
+
+def invalidate_wifi_status():
+    _status_cache['t'] = 0
 
 def get_wifi_status():
+    now = time.monotonic()
+    if _status_cache['t'] and now - _status_cache['t'] < STATUS_CACHE_TTL:
+        return _status_cache['v']
+    status = "Not connected"
     try:
-        output = subprocess.run(
-            ['nmcli', '--terse', '-f', 'ACTIVE,SSID', 'dev', 'wifi'],
-            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        ).stdout.strip()
-        for line in output.splitlines():
-            active, ssid = line.split(':', 1)
-            if active == 'yes':
-                return f"Connected to {ssid}"
+        for path in nm_get_property(NM_PATH, NM_BUS_NAME, 'ActiveConnections'):
+            # Skip connections still activating or failing, e.g. a wrong PSK
+            if (nm_get_property(path, NM_ACTIVE_IFACE, 'Type') != '802-11-wireless'
+                    or nm_get_property(path, NM_ACTIVE_IFACE, 'State') != NM_ACTIVE_STATE_ACTIVATED):
+                continue
+            # Report the real SSID rather than the profile name
+            settings = nm_call(nm_get_property(path, NM_ACTIVE_IFACE, 'Connection'),
+                               NM_CONNECTION_IFACE, 'GetSettings', reply_type='(a{sa{sv}})')[0]
+            ssid = bytes(settings['802-11-wireless']['ssid']).decode('utf-8', 'replace')
+            status = f"Connected to {ssid}"
+            break
     except Exception as e:
-        logging.error(f"Wi-Fi status check failed: {e}")
-    return "Not connected"
+        logging.error("Wi-Fi status check failed: %s", e)
+    _status_cache['t'] = now
+    _status_cache['v'] = status
+    return status
+
+# -------- NetworkManager D-Bus --------
+def nm_call(path, iface, method, args=None, reply_type=None):
+    """Call a NetworkManager D-Bus method over GDBus and return the unpacked reply."""
+    bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+    reply = bus.call_sync(
+        NM_BUS_NAME, path, iface, method, args,
+        GLib.VariantType(reply_type) if reply_type else None,
+        Gio.DBusCallFlags.NONE, -1, None
+    )
+    return reply.unpack() if reply is not None else ()
+
+def nm_get_property(path, iface, name):
+    return nm_call(path, DBUS_PROPERTIES_IFACE, 'Get',
+                   GLib.Variant('(ss)', (iface, name)), '(v)')[0]
+
+def get_wifi_device():
+    """Return the object path of the first Wi-Fi device, or None."""
+    for path in nm_call(NM_PATH, NM_BUS_NAME, 'GetDevices', reply_type='(ao)')[0]:
+        if nm_get_property(path, NM_DEVICE_IFACE, 'DeviceType') == NM_DEVICE_TYPE_WIFI:
+            return path
+    return None
+
+def list_connections():
+    """Return (id, path) for every saved connection profile."""
+    conns = []
+    for path in nm_call(NM_SETTINGS_PATH, NM_SETTINGS_IFACE, 'ListConnections',
+                        reply_type='(ao)')[0]:
+        settings = nm_call(path, NM_CONNECTION_IFACE, 'GetSettings',
+                           reply_type='(a{sa{sv}})')[0]
+        conns.append((settings['connection']['id'], path))
+    return conns
+
+def delete_connections(paths):
+    for path in paths:
+        try:
+            nm_call(path, NM_CONNECTION_IFACE, 'Delete')
+        except Exception as e:
+            logging.error("Failed to delete connection %s: %s", path, e)
+
+def find_access_point(device, ssid):
+    """Return the path of the strongest scanned AP broadcasting ssid, or None."""
+    best, best_strength = None, -1
+    for path in nm_call(device, NM_WIRELESS_IFACE, 'GetAllAccessPoints',
+                        reply_type='(ao)')[0]:
+        if bytes(nm_get_property(path, NM_AP_IFACE, 'Ssid')).decode('utf-8', 'replace') != ssid:
+            continue
+        strength = nm_get_property(path, NM_AP_IFACE, 'Strength')
+        if strength > best_strength:
+            best, best_strength = path, strength
+    return best
+
+def ap_key_mgmt(ap):
+    """Pick key-mgmt from the AP's security flags, as nmcli does.
+
+    WPA3 transition networks also advertise PSK, so sae is only used when
+    that is all the AP offers.
+    """
+    if ap is None:
+        return 'wpa-psk'
+    rsn = nm_get_property(ap, NM_AP_IFACE, 'RsnFlags')
+    wpa = nm_get_property(ap, NM_AP_IFACE, 'WpaFlags')
+    if (rsn | wpa) & NM_AP_SEC_KEY_MGMT_PSK:
+        return 'wpa-psk'
+    if rsn & NM_AP_SEC_KEY_MGMT_SAE:
+        return 'sae'
+    return 'wpa-psk'
+
+def wifi_settings(ssid, password, key_mgmt='wpa-psk'):
+    """Connection settings (a{sa{sv}}) for a WPA-PSK/SAE or open network."""
+    settings = {
+        'connection': {
+            'id': GLib.Variant('s', ssid),
+            'type': GLib.Variant('s', '802-11-wireless'),
+        },
+        '802-11-wireless': {
+            'ssid': GLib.Variant('ay', ssid.encode('utf-8')),
+            'mode': GLib.Variant('s', 'infrastructure'),
+        },
+    }
+    if password:
+        settings['802-11-wireless-security'] = {
+            'key-mgmt': GLib.Variant('s', key_mgmt),
+            'psk': GLib.Variant('s', password),
+        }
+    return settings
+
+def watch_state(path, iface, decide, timeout, callback):
+    """Follow the State of a NetworkManager object until decide(state) returns
+    True or False, then call callback() with it. Gives up with False after
+    timeout seconds."""
+    bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+    done = []
+    subscription = None
+
+    def finish(result):
+        if not done:
+            done.append(True)
+            if subscription is not None:
+                bus.signal_unsubscribe(subscription)
+            callback(result)
+        return False
+
+    def on_state_changed(conn, sender, obj_path, obj_iface, signal, params):
+        result = decide(params.unpack()[0])
+        if result is not None:
+            finish(result)
 
-# -------- BLE Characteristic Callbacks --------
-def read_value():
-    """Return Wi-Fi status and Device ID as byte array for notification/read."""
-    status = get_wifi_status()
-    device_id = load_device_id()
-    payload = f"{status}; Device ID: {device_id}"
-    logging.debug(f"Notify payload: {payload}")
-    return [dbus.Byte(b) for b in payload.encode('utf-8')]
-
-def connect_to_wifi(ssid, password):
     try:
-        subprocess.run(['nmcli', 'networking', 'on'], check=True)
-        time.sleep(1)
-        subprocess.run(['iw', 'reg', 'set', 'IN'], check=True)
-        time.sleep(0.5)
-        subprocess.run(['nmcli', 'device', 'wifi', 'rescan'], check=True)
-        time.sleep(1)
-        result = subprocess.run(
-            ['nmcli', 'device', 'wifi', 'connect', ssid, 'password', password],
-            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        # Subscribe before reading the state so a transition is not missed
+        subscription = bus.signal_subscribe(
+            NM_BUS_NAME, iface, 'StateChanged', path, None,
+            Gio.DBusSignalFlags.NONE, on_state_changed
         )
-        logging.info(f"Wi-Fi connected: {result.stdout.strip()}")
+        result = decide(nm_get_property(path, iface, 'State'))
+    except Exception as e:
+        logging.error("State check for %s failed: %s", path, e)
+        result = False
+    if result is not None:
+        finish(result)
+    else:
+        GLib.timeout_add_seconds(timeout, finish, False)
+
+def device_ready(state):
+    return True if state >= NM_DEVICE_STATE_DISCONNECTED else None
+
+def activation_result(state):
+    if state == NM_ACTIVE_STATE_ACTIVATED:
         return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Wi-Fi connect failed: {e.stderr.strip()}")
+    if state >= NM_ACTIVE_STATE_DEACTIVATING:
         return False
+    return None
+
+# -------- BLE Characteristic Callbacks --------
+# Encoded read/notify payload. It is rebuilt only when the Wi-Fi state or the
+# Device ID changes, so serving a read just returns these bytes.
+_cached_payload = b''
+
+def rebuild_payload():
+    global _cached_payload
+    payload = f"{get_wifi_status()}; Device ID: {load_device_id()}"
+    logging.debug("Notify payload: %s", payload)
+    _cached_payload = payload.encode('utf-8')
+
+def read_value():
+    """Return Wi-Fi status and Device ID as bytes for notification/read."""
+    if not _cached_payload:
+        rebuild_payload()
+    return _cached_payload
+
+def connect_to_wifi(ssid, password, callback=None, replace=False):
+    """Connect through NetworkManager's D-Bus API without blocking the GLib
+    main loop.
+
+    Once the Wi-Fi device is available, a saved profile named after the SSID
+    is activated as is; AddAndActivateConnection is only used when there is
+    none, or when replace is set because the password changed; it is given the
+    matching scanned AP so the key management follows what the network offers.
+    callback(ok) is called when the activation completes or fails.
+    """
+    def finish(ok):
+        if ok:
+            logging.info("Wi-Fi connected: %s", ssid)
+            invalidate_wifi_status()
+            rebuild_payload()
+        else:
+            logging.error("Wi-Fi connect failed: %s", ssid)
+        if callback:
+            callback(ok)
+
+    def connect(device):
+        try:
+            existing = [path for conn_id, path in list_connections() if conn_id == ssid]
+            if replace:
+                delete_connections(existing)
+                existing = []
+            if existing:
+                active = nm_call(
+                    NM_PATH, NM_BUS_NAME, 'ActivateConnection',
+                    GLib.Variant('(ooo)', (existing[0], device, '/')), '(o)'
+                )[0]
+            else:
+                # Tie the new profile to the scanned AP so NM neither guesses
+                # the security nor marks it hidden; '/' only if it is not in range
+                ap = find_access_point(device, ssid)
+                settings = wifi_settings(ssid, password, ap_key_mgmt(ap))
+                _, active = nm_call(
+                    NM_PATH, NM_BUS_NAME, 'AddAndActivateConnection',
+                    GLib.Variant('(a{sa{sv}}oo)', (settings, device, ap or '/')),
+                    '(oo)'
+                )
+        except Exception as e:
+            logging.error("Error connecting Wi-Fi: %s", e)
+            finish(False)
+            return
+        watch_state(active, NM_ACTIVE_IFACE, activation_result, WIFI_CONNECT_TIMEOUT, finish)
+
+    try:
+        if not nm_get_property(NM_PATH, NM_BUS_NAME, 'NetworkingEnabled'):
+            nm_call(NM_PATH, NM_BUS_NAME, 'Enable', GLib.Variant('(b)', (True,)))
+        device = get_wifi_device()
     except Exception as e:
-        logging.error(f"Error connecting Wi-Fi: {e}")
-        return False
+        logging.error("Error connecting Wi-Fi: %s", e)
+        finish(False)
+        return
+    if device is None:
+        logging.error("No Wi-Fi device found")
+        finish(False)
+        return
+    # Proceed once the device can take a connection; on timeout try anyway
+    watch_state(device, NM_DEVICE_IFACE, device_ready, WIFI_READY_TIMEOUT,
+                lambda _: connect(device))
 
 def write_value(data, characteristic):
     """Handle incoming writes: can be Wi-Fi creds or Device ID updates."""
     try:
-        message = ''.join(chr(b) for b in data).strip()
-        logging.debug(f"Received BLE write: {message}")
+        message = bytes(data).decode('utf-8', 'replace').strip()
+        logging.debug("Received BLE write: %s", message)
         # Device ID updates prefixed by DEV::::
         if message.startswith('DEV::::'):
             new_id = message.split('DEV::::', 1)[1]
             save_device_id(new_id)
             # Update notification value
             characteristic.set_value(read_value())
-            logging.info(f"Updated Device ID via BLE: {new_id}")
+            logging.info("Updated Device ID via BLE: %s", new_id)
             return
         # Wi-Fi credentials separated by ++++
         if '++++' in message:
             ssid, pwd = message.split('++++', 1)
-            logging.info(f"Configuring Wi-Fi: SSID={ssid}")
+            logging.info("Configuring Wi-Fi: SSID=%s", ssid)
+            saved_ssid, saved_pwd = load_wifi()
+            # Already on this network with the same password: nothing to redo.
+            # The status is re-read so an activation still in progress (or
+            # failing) is not mistaken for a connection.
+            invalidate_wifi_status()
+            if (saved_ssid, saved_pwd) == (ssid, pwd) and get_wifi_status() == f"Connected to {ssid}":
+                logging.info("Already connected to %s", ssid)
+                characteristic.set_value(read_value())
+                return
             # delete existing except ssid
             try:
-                conns = subprocess.run(['nmcli','-t','-f','NAME','connection','show'],
-                                       check=True, stdout=subprocess.PIPE, text=True).stdout.splitlines()
-                for conn in conns:
-                    if conn != ssid:
-                        subprocess.run(['nmcli','connection','delete',conn], check=True)
+                delete_connections([path for conn_id, path in list_connections() if conn_id != ssid])
                 logging.debug("Old connections cleared")
             except Exception as e:
-                logging.error(f"Failed to clear connections: {e}")
+                logging.error("Failed to clear connections: %s", e)
             # connect and save
-            if connect_to_wifi(ssid, pwd):
-                save_wifi(ssid, pwd)
-            characteristic.set_value(read_value())
+            def on_connected(ok):
+                if ok:
+                    save_wifi(ssid, pwd)
+                characteristic.set_value(read_value())
+            # A changed password needs a fresh profile; otherwise reuse the saved one
+            replace = saved_ssid != ssid or saved_pwd != pwd
+            connect_to_wifi(ssid, pwd, on_connected, replace=replace)
             return
         logging.error("BLE write unrecognized format")
     except Exception as e:
-        logging.error(f"Error in write_value: {e}")
+        logging.error("Error in write_value: %s", e)
+
+# Characteristic to push updates to while a BLE client is subscribed
+_notify_characteristic = None
 
-def update_notify(characteristic):
-    """Periodic notifier callback to push updates."""
-    characteristic.set_value(read_value())
-    return characteristic.is_notifying
+def on_nm_state_changed(*_):
+    invalidate_wifi_status()
+    rebuild_payload()
+    if _notify_characteristic is not None:
+        _notify_characteristic.set_value(read_value())
 
 def notify_callback(notifying, characteristic):
+    global _notify_characteristic
     if notifying:
         logging.info("BLE client subscribed")
-        async_tools.add_timer_seconds(3, update_notify, characteristic)
+        _notify_characteristic = characteristic
+        characteristic.set_value(read_value())
     else:
         logging.info("BLE client unsubscribed")
+        _notify_characteristic = None
 
 # -------- Main BLE Server --------
-def main():
+def setup():
+    """Power the adapter and register the GATT peripheral. Runs once."""
+    # Bluezero exports the GATT objects with dbus-python, which needs this
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    # The regulatory domain is system-wide, so set it once rather than per connect
+    try:
+        subprocess.run(['iw', 'reg', 'set', 'IN'], check=False)
+    except OSError as e:
+        logging.error("Failed to set regulatory domain: %s", e)
+    # Keep the cached payload in step with NetworkManager; subscribed clients
+    # are notified from the handler
+    Gio.bus_get_sync(Gio.BusType.SYSTEM, None).signal_subscribe(
+        NM_BUS_NAME, NM_BUS_NAME, 'StateChanged', NM_PATH, None,
+        Gio.DBusSignalFlags.NONE, on_nm_state_changed
+    )
+    rebuild_payload()
     # Attempt auto-reconnect Wi-Fi
     ssid, pwd = load_wifi()
     if ssid and pwd:
-        logging.info(f"Auto-reconnecting to Wi-Fi {ssid}")
-        connect_to_wifi(ssid, pwd)
+        if get_wifi_status() == f"Connected to {ssid}":
+            logging.info("Already connected to %s", ssid)
+        else:
+            logging.info("Auto-reconnecting to Wi-Fi %s", ssid)
+            connect_to_wifi(ssid, pwd)
     # Setup BLE adapter
     adapters = adapter.list_adapters()
     if not adapters:
@@ -204,8 +499,24 @@ def main():
     )
     periph.publish()
     logging.info("BLE service running; advertising VisitWisePi")
+    return periph
+
+def run():
     GLib.MainLoop().run()
 
+def main():
+    # Register once; after an error only the main loop is restarted so the
+    # peripheral does not have to be re-created and re-registered with BlueZ
+    setup()
+    while True:
+        try:
+            run()
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            logging.error("Main loop error, restarting: %s", e)
+            time.sleep(1)
+
 if __name__ == '__main__':
     if os.geteuid() != 0:
         logging.error("Requires root privileges")
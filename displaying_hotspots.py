@@ -1,20 +1,27 @@
+import os
+import re
 import subprocess
 import time
 
+WPA_CONF = "/etc/wpa_supplicant/wpa_supplicant.conf"
+CONNECT_POLL_INTERVAL = 0.2  # seconds between link checks
+CONNECT_POLL_COUNT = 50  # give up after 10 seconds
+# Matches a whole network={...} block, including its indentation
+NETWORK_BLOCK = re.compile(r"^[ \t]*network=\{.*?^[ \t]*\}[ \t]*\n?", re.DOTALL | re.MULTILINE)
+
 def scan_wifi():
-    # Run the iwlist scan command to get available Wi-Fi networks
-    scan_result = subprocess.check_output(["sudo", "iwlist", "wlan0", "scan"])
-    
-    # Decode the byte output to a string
-    scan_result = scan_result.decode('utf-8')
-    
-    # Parse the result and extract SSIDs (Wi-Fi names)
+    # Ask NetworkManager for nearby networks; terse output is one SSID per line
+    # and does not need root like iwlist does
+    scan_result = subprocess.run(["nmcli", "-t", "-f", "SSID", "dev", "wifi"],
+                                 capture_output=True, text=True, check=True).stdout
+
+    # Unescape colons and drop hidden networks and repeated access points
     networks = []
-    for line in scan_result.split("\n"):
-        if "ESSID" in line:
-            ssid = line.strip().split(":")[1].strip('"')
+    for ssid in scan_result.splitlines():
+        ssid = ssid.replace("\\:", ":")
+        if ssid and ssid not in networks:
             networks.append(ssid)
-    
+
     return networks
 
 def connect_wifi(ssid, password):
@@ -26,16 +33,42 @@ def connect_wifi(ssid, password):
     }}
     """
     
-    # Write configuration to the wpa_supplicant.conf file
-    with open("/etc/wpa_supplicant/wpa_supplicant.conf", "a") as conf_file:
-        conf_file.write(wpa_config)
+    # Drop any existing block for this SSID so reconnecting does not keep
+    # appending duplicates
+    try:
+        with open(WPA_CONF, "r") as conf_file:
+            current = conf_file.read()
+    except FileNotFoundError:
+        current = ""
+    ssid_line = f'ssid="{ssid}"'
+    current = NETWORK_BLOCK.sub(
+        lambda m: "" if ssid_line in m.group(0) else m.group(0), current
+    )
+    current = re.sub(r"\n\s*\n", "\n\n", current)
+
+    # Write the updated configuration through a temp file and swap it in.
+    # The file holds every PSK, so the temp file is created owner-only (0600)
+    tmp_path = WPA_CONF + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # in case a stale temp file was left with other modes
+    with os.fdopen(fd, "w") as conf_file:
+        conf_file.write(current.rstrip() + "\n" + wpa_config)
+        conf_file.flush()
+        os.fsync(conf_file.fileno())
+    os.replace(tmp_path, WPA_CONF)
     
     # Restart the Wi-Fi interface to apply the new configuration
     subprocess.run(["sudo", "wpa_cli", "-i", "wlan0", "reconfigure"])
     
-    # Wait for the connection to be established
+    # Wait for the connection to be established, polling the link instead of
+    # sleeping for the worst case
     print(f"Connecting to {ssid}...")
-    time.sleep(5)  # Give it a few seconds to connect
+    for _ in range(CONNECT_POLL_COUNT):
+        link = subprocess.run(["iw", "dev", "wlan0", "link"],
+                              capture_output=True, text=True).stdout
+        if "Connected to" in link:
+            break
+        time.sleep(CONNECT_POLL_INTERVAL)
     
     # Check if the connection was successful by getting the IP address
     ip_result = subprocess.check_output(["hostname", "-I"]).decode('utf-8').strip()
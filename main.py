@@ -9,34 +9,46 @@ notifier = sdnotify.SystemdNotifier()
 import cv2
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 from picamera2 import Picamera2
 from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput
+from picamera2.outputs import PyavOutput
 from datetime import datetime
 import time
 import os
 import getpass
 import threading
+import queue
 import subprocess
 from libcamera import Transform
 
 # Configuration
+DEVICE_ID_FILE = "/home/neonflake/Desktop/visitwise/device_id.txt"
+# Last Device ID read and the file mtime it was read at; the file is only
+# re-read when BLE provisioning replaces it
+_device_id_cache = {'mtime': None, 'value': "DEV_DEFAULT"}
+
 def load_device_id():
     """Load Device ID from file written by BLE provisioning."""
     try:
-        path = "/home/neonflake/Desktop/visitwise/device_id.txt"
-        with open(path, 'r') as f:
-            device_id = f.read().strip()
+        mtime = os.stat(DEVICE_ID_FILE).st_mtime
+        if mtime != _device_id_cache['mtime']:
+            with open(DEVICE_ID_FILE, 'r') as f:
+                device_id = f.read().strip()
+            _device_id_cache['mtime'] = mtime
             if device_id:
                 print(f"Loaded Device ID: {device_id}")
-                return device_id
+                _device_id_cache['value'] = device_id
             else:
                 print("Device ID file is empty. Using default.")
+                _device_id_cache['value'] = "DEV_DEFAULT"
     except Exception as e:
         print(f"Could not load Device ID: {e}")
-    return "DEV_DEFAULT"
+    return _device_id_cache['value']
 
-DEVICE_ID = load_device_id()
+load_device_id()
 API_URL = "https://visit-wise-llm.jayaprakash.cloud/upload-video"
 VIDEO_DURATION = 5  # seconds
 MOTION_THRESHOLD = 40  # Sensitivity for motion detection
@@ -44,9 +56,32 @@ MIN_MOTION_AREA = 500  # Minimum area of motion to trigger recording
 OUTPUT_DIR = f"/home/{getpass.getuser()}/videos"
 COOLDOWN_PERIOD = 5  # seconds to wait after recording
 UPLOAD_TIMEOUT = 30  # seconds for upload timeout
+UPLOAD_WORKERS = 2  # clips uploaded in parallel
+UPLOAD_QUEUE_SIZE = 8  # pending clips before recording threads wait
 VIDEO_RESOLUTION = (1280, 720)  # 720p resolution
 FRAME_RATE = 30
 ROTATION = Transform(rotation=-270)  # Rotate 90 degrees clockwise
+MOTION_SCALE = 4  # Motion detection runs on frames downscaled by this factor
+MOTION_CHECK_INTERVAL = 3  # Run motion detection on every Nth camera frame
+WATCHDOG_INTERVAL = 1.0  # seconds between systemd watchdog pings
+
+def motion_mask(prev, cur, out):
+    """Threshold |prev - cur| into out, reusing one buffer for both steps."""
+    cv2.absdiff(prev, cur, dst=out)
+    cv2.threshold(out, MOTION_THRESHOLD, 255, cv2.THRESH_BINARY, dst=out)
+    return out
+
+# Uploads go through a fixed set of long-lived workers sharing one session so
+# the HTTPS connections to the API are kept alive and reused between clips.
+# The queue is bounded so a slow uplink holds back recording threads instead
+# of piling up work.
+session = requests.Session()
+# Only connection failures are retried, since the streamed body cannot be replayed
+session.mount('https://', HTTPAdapter(
+    pool_connections=1, pool_maxsize=UPLOAD_WORKERS,
+    max_retries=Retry(total=None, connect=2, read=0, status=0, other=0, backoff_factor=0.3)
+))
+upload_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
 
 def ensure_output_directory():
     """Ensure the output directory exists and is writable."""
@@ -66,38 +101,30 @@ def upload_video(video_path):
     """Upload video to API and delete local files after successful upload."""
     try:
         with open(video_path, 'rb') as video_file:
-            files = {'file': (os.path.basename(video_path), video_file, 'video/mp4')}
-            params = {'deviceId': DEVICE_ID}
+            # Stream the multipart body from the file instead of building it in memory
+            body = MultipartEncoder(fields={'file': (os.path.basename(video_path), video_file, 'video/mp4')})
+            params = {'deviceId': load_device_id()}
             print(f"Uploading video: {video_path}")
-            response = requests.post(API_URL, files=files, params=params, timeout=UPLOAD_TIMEOUT)
+            response = session.post(API_URL, data=body, headers={'Content-Type': body.content_type},
+                                    params=params, timeout=UPLOAD_TIMEOUT)
             if response.status_code == 200:
                 print(f"Video uploaded successfully: {video_path}")
-                time.sleep(0.5)  # Ensure file handles are released
-
-                # Delete both .mp4 and .h264 files
-                for file_path in [video_path, video_path.replace('.h264', '.mp4')]:
-                    retry_count = 3
-                    while retry_count > 0:
-                        try:
-                            if os.path.exists(file_path):
-                                os.chmod(file_path, 0o666)
-                                subprocess.run(['sudo', 'rm', '-f', file_path], check=True)
-                                print(f"Deleted local file: {file_path}")
-                                break
-                            else:
-                                print(f"File not found for deletion: {file_path}")
-                                break
-                        except PermissionError as pe:
-                            print(f"Permission error deleting {file_path}: {str(pe)}")
-                        except OSError as oe:
-                            print(f"OS error deleting {file_path}: {str(oe)}")
-                        except Exception as e:
-                            print(f"Unexpected error deleting {file_path}: {str(e)}")
-                        retry_count -= 1
-                        time.sleep(1)
-
-                    if retry_count == 0:
-                        print(f"Failed to delete {file_path} after retries")
+                # Delete the uploaded clip; a single unlink, no stat or chmod first
+                try:
+                    os.remove(video_path)
+                    print(f"Deleted local file: {video_path}")
+                except FileNotFoundError:
+                    print(f"File not found for deletion: {video_path}")
+                except PermissionError:
+                    # unlink needs write access to OUTPUT_DIR (and, with the sticky bit,
+                    # ownership); fall back to root if the directory denies it
+                    result = subprocess.run(['sudo', 'rm', '-f', video_path])
+                    if result.returncode == 0:
+                        print(f"Deleted local file: {video_path}")
+                    else:
+                        print(f"Failed to delete {video_path}")
+                except OSError as e:
+                    print(f"OS error deleting {video_path}: {str(e)}")
                 return True
             else:
                 print(f"Upload failed with status code {response.status_code}")
@@ -107,34 +134,32 @@ def upload_video(video_path):
         print(f"Unexpected error during upload: {str(e)}")
     return False
 
-def record_and_convert(picam2, encoder, video_path):
-    """Record video and convert to MP4 using ffmpeg."""
+def record_clip(picam2, encoder, video_path):
+    """Record a clip straight into an MP4 container."""
     try:
-        output = FileOutput(video_path)
+        output = PyavOutput(video_path)
         print(f"Starting recording: {video_path}")
         picam2.start_encoder(encoder, output)
         time.sleep(VIDEO_DURATION)
         picam2.stop_encoder()
-        output.close()
         print(f"Recording stopped: {video_path}")
-
-        mp4_path = video_path.replace('.h264', '.mp4')
-        command = ["ffmpeg", "-y", "-i", video_path, "-c:v", "copy", "-c:a", "aac", mp4_path]
-        result = subprocess.run(command, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"FFmpeg conversion failed for {video_path}: {result.stderr}")
-            return None
-        print(f"Converted to MP4: {mp4_path}")
-        return mp4_path
+        return video_path
     except Exception as e:
-        print(f"Recording/conversion error: {str(e)}")
+        print(f"Recording error: {str(e)}")
         return None
 
+def upload_worker():
+    """Upload queued clips over the shared session."""
+    while True:
+        mp4_path = upload_queue.get()
+        upload_video(mp4_path)
+        upload_queue.task_done()
+
 def handle_motion(picam2, encoder, video_path):
-    """Handle motion: record and upload."""
-    mp4_path = record_and_convert(picam2, encoder, video_path)
+    """Handle motion: record, then queue the clip for upload."""
+    mp4_path = record_clip(picam2, encoder, video_path)
     if mp4_path:
-        upload_video(mp4_path)
+        upload_queue.put(mp4_path)
 
 def main():
     if not ensure_output_directory():
@@ -149,18 +174,49 @@ def main():
     picam2.configure(video_config)
     encoder = H264Encoder()
     picam2.start()
-
+    for i in range(UPLOAD_WORKERS):
+        threading.Thread(target=upload_worker, name=f"upload-{i}", daemon=True).start()
+
+    width, height = VIDEO_RESOLUTION
+    motion_size = (width // MOTION_SCALE, height // MOTION_SCALE)
+    # MIN_MOTION_AREA was tuned on a full-res mask dilated twice, which let
+    # a ~20 px object through. The small mask is not dilated; count the pixels
+    # such an object covers once downscaling has blurred its edges.
+    min_area = ((MIN_MOTION_AREA ** 0.5 - 1) / MOTION_SCALE) ** 2
+    shape = (motion_size[1], motion_size[0])
+    mask = np.empty(shape, np.uint8)
+    # Two frame buffers used in turn for the current and previous frame
+    frames = [np.empty(shape, np.uint8), np.empty(shape, np.uint8)]
+    idx = 0
     prev_frame = None
+    frame_count = 0
+    last_watchdog = 0.0
     last_motion_time = 0
     is_recording = False
 
     try:
         while True:
+            # Tell systemd we are alive, at most once per WATCHDOG_INTERVAL
+            now = time.monotonic()
+            if now - last_watchdog >= WATCHDOG_INTERVAL:
+                notifier.notify("WATCHDOG=1")
+                last_watchdog = now
+
+            # capture_metadata() blocks until the next frame without copying
+            # it, so only every MOTION_CHECK_INTERVAL-th frame is fetched
+            frame_count += 1
+            if frame_count % MOTION_CHECK_INTERVAL:
+                picam2.capture_metadata()
+                continue
             frame = picam2.capture_array()
-            gray = cv2.cvtColor(frame, cv2.COLOR_YUV420p2GRAY)
+            # The YUV420 array starts with the full-resolution Y (luma) plane,
+            # which is already the grayscale image; shrink it for detection
+            gray = cv2.resize(frame[:height, :width], motion_size, dst=frames[idx],
+                              interpolation=cv2.INTER_AREA)
 
             if prev_frame is None:
                 prev_frame = gray
+                idx ^= 1
                 continue
 
             current_time = time.time()
@@ -168,20 +224,17 @@ def main():
                 time.sleep(0.1)
                 continue
 
-            frame_delta = cv2.absdiff(prev_frame, gray)
-            thresh = cv2.threshold(frame_delta, MOTION_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=2)
-            contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            thresh = motion_mask(prev_frame, gray, mask)
+            motion_detected = cv2.countNonZero(thresh) > min_area
 
-            motion_detected = any(cv2.contourArea(c) > MIN_MOTION_AREA for c in contours)
-
-            prev_frame = gray.copy()
+            prev_frame = gray
+            idx ^= 1
 
             if motion_detected and not is_recording:
                 is_recording = True
                 last_motion_time = current_time
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                video_path = os.path.join(OUTPUT_DIR, f"motion_{timestamp}.h264")
+                video_path = os.path.join(OUTPUT_DIR, f"motion_{timestamp}.mp4")
                 print(f"Motion triggered recording: {video_path}")
 
                 threading.Thread(target=handle_motion, args=(picam2, encoder, video_path)).start()
@@ -189,8 +242,6 @@ def main():
                 time.sleep(0.1)
                 is_recording = False
 
-            time.sleep(0.1)
-
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
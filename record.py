@@ -3,14 +3,18 @@
 import cv2
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 from picamera2 import Picamera2
 from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput
+from picamera2.outputs import PyavOutput
 from datetime import datetime
 import time
 import os
 import getpass
 import threading
+import queue
 from libcamera import Transform
 
 # Configuration
@@ -23,11 +27,33 @@ MIN_MOTION_AREA = 500  # Increased for 480p resolution
 OUTPUT_DIR = f"/home/{getpass.getuser()}/videos"
 COOLDOWN_PERIOD = 5  # seconds to wait after recording
 UPLOAD_TIMEOUT = 20  # seconds for upload timeout
+UPLOAD_WORKERS = 2  # clips uploaded in parallel
+UPLOAD_QUEUE_SIZE = 8  # pending clips before recording threads wait
 #VIDEO_RESOLUTION = (640, 480)  # 480p resolution
 VIDEO_RESOLUTION = (1280, 1080)  # 720p resolution
 
 FRAME_RATE = 60
 ROTATION = Transform(rotation=-270)  # Rotate 90 degrees clockwise
+MOTION_SCALE = 4  # Motion detection runs on frames downscaled by this factor
+MOTION_CHECK_INTERVAL = 3  # Run motion detection on every Nth camera frame
+
+def motion_mask(prev, cur, out):
+    """Threshold |prev - cur| into out, reusing one buffer for both steps."""
+    cv2.absdiff(prev, cur, dst=out)
+    cv2.threshold(out, MOTION_THRESHOLD, 255, cv2.THRESH_BINARY, dst=out)
+    return out
+
+# Uploads go through a fixed set of long-lived workers sharing one session so
+# the HTTPS connections to the API are kept alive and reused between clips.
+# The queue is bounded so a slow uplink holds back recording threads instead
+# of piling up work.
+session = requests.Session()
+# Only connection failures are retried, since the streamed body cannot be replayed
+session.mount('https://', HTTPAdapter(
+    pool_connections=1, pool_maxsize=UPLOAD_WORKERS,
+    max_retries=Retry(total=None, connect=2, read=0, status=0, other=0, backoff_factor=0.3)
+))
+upload_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
 
 def ensure_output_directory():
     """Ensure the output directory exists and is writable."""
@@ -47,20 +73,19 @@ def upload_video(video_path):
     """Upload video to API with timeout."""
     try:
         with open(video_path, 'rb') as video_file:
-            files = {'file': (os.path.basename(video_path), video_file, 'video/mp4')}
+            # Stream the multipart body from the file instead of building it in memory
+            body = MultipartEncoder(fields={'file': (os.path.basename(video_path), video_file, 'video/mp4')})
             params = {'deviceId': DEVICE_ID}
             print(f"Uploading video: {video_path}")
-            response = requests.post(API_URL, files=files, params=params, timeout=UPLOAD_TIMEOUT)
+            response = session.post(API_URL, data=body, headers={'Content-Type': body.content_type},
+                                    params=params, timeout=UPLOAD_TIMEOUT)
             if response.status_code == 200:
                 print(f"Video uploaded successfully: {video_path}")
                 try:
                     os.remove(video_path)
-                    h264_path = video_path.replace('.mp4', '.h264')
-                    if os.path.exists(h264_path):
-                        os.remove(h264_path)
-                    print(f"Deleted local files: {video_path}, {h264_path}")
+                    print(f"Deleted local file: {video_path}")
                 except Exception as e:
-                    print(f"Error deleting local files: {str(e)}")
+                    print(f"Error deleting local file: {str(e)}")
 		   # print(f"Upload successful: Status {response.status_code}, {response.text}")
                 return True
             else:
@@ -73,33 +98,32 @@ def upload_video(video_path):
         print(f"Unexpected error during upload: {str(e)}")
         return False
 
-def record_and_convert(picam2, encoder, video_path):
-    """Record video and convert to MP4."""
+def record_clip(picam2, encoder, video_path):
+    """Record a clip straight into an MP4 container."""
     try:
-        output = FileOutput(video_path)
+        output = PyavOutput(video_path)
         print(f"Starting recording: {video_path}")
         picam2.start_encoder(encoder, output)
         time.sleep(VIDEO_DURATION)
         picam2.stop_encoder()
         print(f"Recording stopped: {video_path}")
-        
-        mp4_path = video_path.replace('.h264', '.mp4')
-        command = f"ffmpeg -y -i {video_path} -c:v copy -c:a aac {mp4_path}"
-        result = os.system(command)
-        if result != 0:
-            print(f"FFmpeg conversion failed for {video_path}")
-            return None
-        print(f"Converted to MP4: {mp4_path}")
-        return mp4_path
+        return video_path
     except Exception as e:
-        print(f"Recording/conversion error: {str(e)}")
+        print(f"Recording error: {str(e)}")
         return None
 
+def upload_worker():
+    """Upload queued clips over the shared session."""
+    while True:
+        mp4_path = upload_queue.get()
+        upload_video(mp4_path)
+        upload_queue.task_done()
+
 def handle_motion(picam2, encoder, video_path):
-    """Handle motion: record and upload."""
-    mp4_path = record_and_convert(picam2, encoder, video_path)
+    """Handle motion: record, then queue the clip for upload."""
+    mp4_path = record_clip(picam2, encoder, video_path)
     if mp4_path:
-        upload_video(mp4_path)
+        upload_queue.put(mp4_path)
 
 def main():
     if not ensure_output_directory():
@@ -114,18 +138,42 @@ def main():
     picam2.configure(video_config)
     encoder = H264Encoder()
     picam2.start()
-
+    for i in range(UPLOAD_WORKERS):
+        threading.Thread(target=upload_worker, name=f"upload-{i}", daemon=True).start()
+
+    width, height = VIDEO_RESOLUTION
+    motion_size = (width // MOTION_SCALE, height // MOTION_SCALE)
+    # MIN_MOTION_AREA was tuned on a full-res mask dilated twice, which let
+    # a ~20 px object through. The small mask is not dilated; count the pixels
+    # such an object covers once downscaling has blurred its edges.
+    min_area = ((MIN_MOTION_AREA ** 0.5 - 1) / MOTION_SCALE) ** 2
+    shape = (motion_size[1], motion_size[0])
+    mask = np.empty(shape, np.uint8)
+    # Two frame buffers used in turn for the current and previous frame
+    frames = [np.empty(shape, np.uint8), np.empty(shape, np.uint8)]
+    idx = 0
     prev_frame = None
+    frame_count = 0
     last_motion_time = 0
     is_recording = False
 
     try:
         while True:
+            # capture_metadata() blocks until the next frame without copying
+            # it, so only every MOTION_CHECK_INTERVAL-th frame is fetched
+            frame_count += 1
+            if frame_count % MOTION_CHECK_INTERVAL:
+                picam2.capture_metadata()
+                continue
             frame = picam2.capture_array()
-            gray = cv2.cvtColor(frame, cv2.COLOR_YUV420p2GRAY)
+            # The YUV420 array starts with the full-resolution Y (luma) plane,
+            # which is already the grayscale image; shrink it for detection
+            gray = cv2.resize(frame[:height, :width], motion_size, dst=frames[idx],
+                              interpolation=cv2.INTER_AREA)
 
             if prev_frame is None:
                 prev_frame = gray
+                idx ^= 1
                 continue
 
             current_time = time.time()
@@ -133,26 +181,20 @@ def main():
                 time.sleep(0.1)
                 continue
 
-            frame_delta = cv2.absdiff(prev_frame, gray)
-            thresh = cv2.threshold(frame_delta, MOTION_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=2)
-            contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            motion_detected = False
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                if area > MIN_MOTION_AREA:
-                    print(f"Motion detected with area: {area}")
-                    motion_detected = True
-                    break
+            thresh = motion_mask(prev_frame, gray, mask)
+            motion_area = cv2.countNonZero(thresh)
+            motion_detected = motion_area > min_area
+            if motion_detected:
+                print(f"Motion detected with area: {motion_area * MOTION_SCALE * MOTION_SCALE}")
 
-            prev_frame = gray.copy()
+            prev_frame = gray
+            idx ^= 1
 
             if motion_detected and not is_recording:
                 is_recording = True
                 last_motion_time = current_time
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                video_path = os.path.join(OUTPUT_DIR, f"motion_{timestamp}.h264")
+                video_path = os.path.join(OUTPUT_DIR, f"motion_{timestamp}.mp4")
                 print(f"Motion triggered recording: {video_path}")
 
                 threading.Thread(target=handle_motion, args=(picam2, encoder, video_path)).start()
@@ -160,8 +202,6 @@ def main():
                 time.sleep(0.1)
                 is_recording = False
 
-            time.sleep(0.1)
-
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
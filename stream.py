@@ -1,26 +1,35 @@
 from flask import Flask, Response
-import cv2
 from picamera2 import Picamera2
-import time
+from picamera2.encoders import MJPEGEncoder
+from picamera2.outputs import FileOutput
+from threading import Condition
+import io
 
 app = Flask(__name__)
 
-# Initialize the PiCamera
+class StreamingOutput(io.BufferedIOBase):
+    """Holds the latest JPEG from the encoder and wakes up waiting clients."""
+    def __init__(self):
+        self.frame = None
+        self.condition = Condition()
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = buf
+            self.condition.notify_all()
+
+# Initialize the PiCamera and let the hardware MJPEG encoder produce the JPEGs
 picam2 = Picamera2()
-picam2.start()
+picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
+output = StreamingOutput()
+picam2.start_recording(MJPEGEncoder(), FileOutput(output))
 
 def generate_frames():
     while True:
-        # Capture frame-by-frame
-        frame = picam2.capture_array()
-
-        # Convert the frame to JPEG
-        ret, buffer = cv2.imencode('.jpg', frame)
-        if not ret:
-            continue
-        
-        # Convert the frame to a byte array
-        frame = buffer.tobytes()
+        # Wait for the encoder to deliver the next JPEG
+        with output.condition:
+            output.condition.wait()
+            frame = output.frame
 
         # Yield the frame to the client
         yield (b'--frame\r\n'
@@ -36,4 +45,5 @@ def index():
     return "Visit /video to view the live stream."
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, threaded=True)
+    # A single process so the camera opened above is never forked
+    app.run(host='0.0.0.0', port=5000, threaded=True, processes=1)